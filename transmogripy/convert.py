@@ -2,8 +2,11 @@ from typing import Union
 
 from enum import Enum
 from io import StringIO
+from concurrent.futures import Executor, ProcessPoolExecutor
+import os
 import re
 import warnings
+from time import perf_counter
 
 from .rule import LineComponents, Final
 from .rules import get_rules
@@ -16,41 +19,25 @@ class ResultBehaviour(Enum):
     var = 'variable'
 
 
-def convert(pascal: str, check_syntax=True, result_behaviour: Union[str, ResultBehaviour] = 'try', disclose=True,
-            remove_inline_comments=True, pre_parts=('from talos import *',), post_parts=()):
+def _add_timing(timings, phase, start):
     """
-    convert a pascal script to a python script
-    :param pascal: the pascal script as a single string
-    :param check_syntax: whether to check the python syntax of the output and issue a warning if any errors are found
-    :param result_behaviour: how to handle the result variable
-    :param disclose: whether to add a disclosure tot he output stating it was automatically generated
-    :param remove_inline_comments: whether to remove inline comments in the source code. Setting this to false will
-        raise an error if inline comments are found.
-    :param pre_parts: any text to add before the output code should be entered here
-    :param post_parts: any text to add after the output code should be entered here
-    :return: the python script as a string
+    add the time elapsed since start to the phase's entry in timings (if timings is not None)
+    :return: the current time, to be used as the start of the next phase
     """
-    result_behaviour = ResultBehaviour(result_behaviour)
-    result_as_var = result_behaviour == ResultBehaviour.var
-    pre_words, post_words, rules = get_rules(result_as_var, disclose=disclose,
-                                             pre_raw_parts=pre_parts, post_raw_parts=post_parts)
-    env = {}
+    now = perf_counter()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + now - start
+    return now
 
-    lines = list(
-        filter_multiline_comments(pascal.splitlines(keepends=False), remove_inline_comments=remove_inline_comments))
-    # just treat single-line scripts as though they have a begin and end around them
-    if len(lines) in (0, 1):
-        lines = ['begin', *('\t' + l for l in lines), 'end']
-    else:
-        try:
-            var_index = lines.index('var')
-        except ValueError:
-            # if there is no var, then delete nothing (we want to keep anything before begin in case it's a comment)
-            pass
-        else:
-            begin_index = lines.index('begin', var_index)
-            del lines[var_index:begin_index]
 
+def convert_line_major(lines, rules, env):
+    """
+    convert the body lines of a script, running every line component through all the rules before moving on to the next
+    :param lines: the lines of the script, after comment filtering
+    :param rules: the rules to apply
+    :param env: the environment passed to the rules, updated in place
+    :return: the converted lines, as a single string
+    """
     ret = StringIO()
 
     for line in lines:
@@ -69,11 +56,7 @@ def convert(pascal: str, check_syntax=True, result_behaviour: Union[str, ResultB
             else:
                 env['last_component'] = comp_ind + 1 == len(comps)
                 for rule in rules:
-                    try:
-                        res = rule(comp, env)
-                    except EarlyReturnDetected:
-                        return convert(pascal, check_syntax, 'variable', disclose, remove_inline_comments, pre_parts,
-                                       post_parts)
+                    res = rule(comp, env)
                     if res is not None:
                         comp = comps[comp_ind] = res
                         if not isinstance(res, str):
@@ -89,12 +72,278 @@ def convert(pascal: str, check_syntax=True, result_behaviour: Union[str, ResultB
         if not isblank(line):
             ret.write(line + '\n')
 
-    ret = pre_words.join() + ret.getvalue() + post_words.join()
-    ret = ret.rstrip() + '\n'  # add a single trailing newline as per PEP8
+    return ret.getvalue()
+
+
+RULE_MAJOR_BLOCK_LINES = 1024  # the number of lines convert_rule_major applies each rule to at once
+
+
+def convert_rule_major(lines, rules, env):
+    """
+    convert the body lines of a script, applying each rule to all the pending line components at once. This gives the
+    same output as convert_line_major, but the number of python-level calls scales with the number of rules rather
+    than with the number of lines times the number of rules, since each rule only gets called for the components
+    its Rule.candidates reports.
+
+    The components are processed in sweeps: in each sweep, every line's first non-final component runs through the
+    rules until it is split or finalized. Components that are split off are handled by the next sweep. Long scripts are
+    processed in blocks of RULE_MAJOR_BLOCK_LINES lines, and processing stops at the first block that raises. Hooks and
+    errors are recorded with their (line, sweep, rule) position, so they are replayed (or raised) in the order the
+    line-major conversion would have encountered them.
+    :param lines: the lines of the script, after comment filtering
+    :param rules: the rules to apply
+    :param env: the environment passed to the rules, its 'prev_indent' is updated in place
+    :return: the converted lines, as a single string
+    """
+    line_comps = [None] * len(lines)
+    prev_indents = [None] * len(lines)
+    prev_indent = env.get('prev_indent')
+    for line_ind, line in enumerate(lines):
+        # note: we want to pass blank lines only if it was blank in the original!
+        if isblank(line):
+            continue
+        line_comps[line_ind] = LineComponents(line)
+        prev_indents[line_ind] = prev_indent
+        prev_indent = re.match('^\s*', line).group(0)
+
+    deferred_hooks = []
+    hook_log = []
+    errors = []
+    # the line-major conversion would stop at the first error, so only the lines before it still matter
+    first_error_line = len(lines)
+    # the lines are converted in blocks, so that an error (like an early return) near the start of a long script
+    # doesn't cost a pass over all of it
+    for block_start in range(0, len(lines), RULE_MAJOR_BLOCK_LINES):
+        pending = [i for i in range(block_start, min(block_start + RULE_MAJOR_BLOCK_LINES, len(lines)))
+                   if line_comps[i] is not None]
+        sweep = 0
+        while pending:
+            # every item is the index of a line and the index of the component in it that is processed in this sweep
+            items = []
+            for line_ind in pending:
+                comps = line_comps[line_ind]
+                non_final = comps.non_final_part()
+                while non_final and not non_final[1]:
+                    comps[non_final[0]] = Final(non_final[1])
+                    non_final = comps.non_final_part()
+                if non_final:
+                    items.append((line_ind, non_final[0]))
+            pending = [line_ind for (line_ind, _) in items]
+            buffer = [line_comps[line_ind].parts[comp_ind] for (line_ind, comp_ind) in items]
+
+            for rule_ind, rule in enumerate(rules):
+                if not items:
+                    break
+                done = set()
+                for item_ind in rule.candidates(buffer):
+                    line_ind, comp_ind = items[item_ind]
+                    comps = line_comps[line_ind]
+                    item_env = {'last_component': comp_ind + 1 == len(comps), 'deferred_hooks': deferred_hooks}
+                    if prev_indents[line_ind] is not None:
+                        item_env['prev_indent'] = prev_indents[line_ind]
+                    try:
+                        res = rule(buffer[item_ind], item_env)
+                    except Exception as e:
+                        errors.append(((line_ind, sweep, rule_ind), e))
+                        first_error_line = min(first_error_line, line_ind)
+                        done.add(item_ind)
+                        # the candidates are in line order, so the rest are all after the error
+                        break
+                    if deferred_hooks:
+                        hook_log.extend(((line_ind, sweep, rule_ind), hook) for hook in deferred_hooks)
+                        deferred_hooks.clear()
+                    if res is not None:
+                        buffer[item_ind] = comps[comp_ind] = res
+                        if not isinstance(res, str):
+                            done.add(item_ind)
+                        elif not res:
+                            comps[comp_ind] = Final(res)
+                            done.add(item_ind)
+                if done:
+                    kept = [i for (i, (line_ind, _)) in enumerate(items)
+                            if i not in done and line_ind < first_error_line]
+                    items = [items[i] for i in kept]
+                    buffer = [buffer[i] for i in kept]
+
+            if errors:
+                pending = [line_ind for line_ind in pending if line_ind < first_error_line]
+            sweep += 1
+        if errors:
+            break
+
+    if errors:
+        raise min(errors, key=lambda e: e[0])[1]
+    for _, hook in sorted(hook_log, key=lambda h: h[0]):
+        hook()
+
+    ret = StringIO()
+    for comps in line_comps:
+        if comps is None:
+            ret.write('\n')
+            continue
+        line = ''.join(comps)
+        if not isblank(line):
+            ret.write(line + '\n')
+    if prev_indent is not None:
+        env['prev_indent'] = prev_indent
+    return ret.getvalue()
+
+
+PARALLEL_CHUNK_LINES = 1000  # the minimum number of lines in each chunk of a parallel conversion
+
+
+def _convert_chunk(lines, prev_indent, result_as_var, rule_major):
+    """
+    convert a chunk of body lines with a fresh set of rules, to be run in a worker process
+    :return: the converted lines, and the names of the pre-word parts the chunk activated, in order
+    """
+    pre_words, _, rules = get_rules(result_as_var, disclose=False)
+    env = {}
+    if prev_indent is not None:
+        env['prev_indent'] = prev_indent
+    if rule_major:
+        ret = convert_rule_major(lines, rules, env)
+    else:
+        ret = convert_line_major(lines, rules, env)
+    part_names = {v: k for (k, v) in pre_words.PARTS.items()}
+    return ret, [part_names[part] for part in pre_words]
+
+
+def convert_parallel(lines, result_as_var, pre_words, executor: Executor, chunk_count, rule_major=False):
+    """
+    convert the body lines of a script by splitting them into chunks and converting the chunks in parallel. The only
+    state carried from one line to the next is the indent of the previous non-blank line, so every chunk is given the
+    indent of the line before it. The output is the same as a serial conversion.
+    :param lines: the lines of the script, after comment filtering
+    :param result_as_var: the result_as_var argument for the rules
+    :param pre_words: the pre-word segment, the parts the chunks activate are added to it in order
+    :param executor: the executor to run the chunks in
+    :param chunk_count: the number of chunks to split the lines into
+    :param rule_major: whether to convert each chunk with convert_rule_major
+    :return: the converted lines, as a single string
+    >>> import sys
+    >>> module = sys.modules['transmogripy.convert']
+    >>> body = ['var', '  a: integer;', 'begin', '  a := 10; { a comment }', "  s := '{not a comment}' + IntToStr(a);",
+    ...         '  b := random(3) + exp(2) + power(2, 3);', '  y := (a > 1) and', '    (b < 2);',
+    ...         '  z := a + // not the last component', '    b;', '  repeat', '    a := a + 1;', '  until a = 20;',
+    ...         '  if a = 1 then', '    Result := 1;']
+    >>> saved = module.PARALLEL_CHUNK_LINES, module.RULE_MAJOR_BLOCK_LINES
+    >>> module.PARALLEL_CHUNK_LINES = module.RULE_MAJOR_BLOCK_LINES = 4
+    >>> try:
+    ...     for tail in (['end'], ['  x := 1 + Result;', 'end']):  # the second one returns early
+    ...         script = '\\n'.join(body + tail)
+    ...         expected = convert(script, check_syntax=False)
+    ...         assert convert(script, check_syntax=False, rule_major=True) == expected
+    ...         assert convert(script, check_syntax=False, parallel=3) == expected
+    ...         assert convert(script, check_syntax=False, rule_major=True, parallel=3) == expected
+    ... finally:
+    ...     module.PARALLEL_CHUNK_LINES, module.RULE_MAJOR_BLOCK_LINES = saved
+    """
+    chunk_size = -(-len(lines) // chunk_count)
+    futures = []
+    prev_indent = None
+    for chunk_start in range(0, len(lines), chunk_size):
+        chunk = lines[chunk_start:chunk_start + chunk_size]
+        futures.append(executor.submit(_convert_chunk, chunk, prev_indent, result_as_var, rule_major))
+        for line in reversed(chunk):
+            if not isblank(line):
+                prev_indent = re.match('^\s*', line).group(0)
+                break
+
+    ret = []
+    try:
+        for future in futures:
+            # if a chunk raises, the serial conversion would have stopped there too, so the later chunks don't matter
+            chunk_ret, part_names = future.result()
+            ret.append(chunk_ret)
+            for part_name in part_names:
+                pre_words.add_part(part_name)
+    finally:
+        for future in futures:
+            future.cancel()
+    return ''.join(ret)
+
+
+def convert(pascal: str, check_syntax=True, result_behaviour: Union[str, ResultBehaviour] = 'try', disclose=True,
+            remove_inline_comments=True, pre_parts=('from talos import *',), post_parts=(), timings=None,
+            rule_major=False, parallel: Union[None, int, Executor] = None):
+    """
+    convert a pascal script to a python script
+    :param pascal: the pascal script as a single string
+    :param check_syntax: whether to check the python syntax of the output and issue a warning if any errors are found
+    :param result_behaviour: how to handle the result variable
+    :param disclose: whether to add a disclosure tot he output stating it was automatically generated
+    :param remove_inline_comments: whether to remove inline comments in the source code. Setting this to false will
+        raise an error if inline comments are found.
+    :param pre_parts: any text to add before the output code should be entered here
+    :param post_parts: any text to add after the output code should be entered here
+    :param timings: if a dict is given, the seconds spent in each phase of the conversion ('filter', 'rules',
+        'syntax') are added to it
+    :param rule_major: whether to apply each rule to all the lines at once (see convert_rule_major) instead of applying
+        all the rules to each line in turn. The output is the same either way.
+    :param parallel: if set, long scripts are split into chunks that are converted in parallel (see convert_parallel).
+        Either the number of worker processes to use, or an executor to run the chunks in (in which case the script is
+        split into as many chunks as there are CPUs). The output is the same either way.
+    :return: the python script as a string
+    """
+    result_behaviour = ResultBehaviour(result_behaviour)
+    result_as_var = result_behaviour == ResultBehaviour.var
+    pre_words, post_words, rules = get_rules(result_as_var, disclose=disclose,
+                                             pre_raw_parts=pre_parts, post_raw_parts=post_parts)
+    env = {}
+
+    start = perf_counter()
+    lines = list(
+        filter_multiline_comments(pascal.splitlines(keepends=False), remove_inline_comments=remove_inline_comments))
+    # just treat single-line scripts as though they have a begin and end around them
+    if len(lines) in (0, 1):
+        lines = ['begin', *('\t' + l for l in lines), 'end']
+    else:
+        try:
+            var_index = lines.index('var')
+        except ValueError:
+            # if there is no var, then delete nothing (we want to keep anything before begin in case it's a comment)
+            pass
+        else:
+            begin_index = lines.index('begin', var_index)
+            del lines[var_index:begin_index]
+    start = _add_timing(timings, 'filter', start)
+
+    if isinstance(parallel, Executor):
+        workers = os.cpu_count()
+    else:
+        workers = parallel or 1
+    chunk_count = min(workers, len(lines) // PARALLEL_CHUNK_LINES)
+
+    early_return = False
+    try:
+        if chunk_count > 1:
+            if isinstance(parallel, Executor):
+                ret = convert_parallel(lines, result_as_var, pre_words, parallel, chunk_count, rule_major)
+            else:
+                with ProcessPoolExecutor(chunk_count) as executor:
+                    ret = convert_parallel(lines, result_as_var, pre_words, executor, chunk_count, rule_major)
+        elif rule_major:
+            ret = convert_rule_major(lines, rules, env)
+        else:
+            ret = convert_line_major(lines, rules, env)
+    except EarlyReturnDetected:
+        early_return = True
+    else:
+        ret = pre_words.join() + ret + post_words.join()
+        ret = ret.rstrip() + '\n'  # add a single trailing newline as per PEP8
+    finally:
+        # record the time even if a rule raised, so that slow unsupported files still show up in the timings
+        start = _add_timing(timings, 'rules', start)
+
+    if early_return:
+        return convert(pascal, check_syntax, 'variable', disclose, remove_inline_comments, pre_parts,
+                       post_parts, timings, rule_major, parallel)
     if check_syntax:
         valid, error = is_valid_python(ret)
         if not valid:
             warnings.warn(
                 f'the python script did not pass syntax checking, the error was: {error}',
                 category=FatalTransmogripyWarning)
+        _add_timing(timings, 'syntax', start)
     return ret
@@ -0,0 +1,179 @@
+from typing import Iterable, Iterator, Tuple, List, Optional
+
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import os
+import queue
+import re
+import threading
+
+
+def match_path(rel_path: str, pattern: str):
+    """
+    check whether a relative path (with '/' separators) matches a pattern. A pattern without a '/' is matched against
+    the file name alone, at any depth. Otherwise, it is matched against the whole path, one directory at a time, where a
+    '**' directory matches any number of directories. A leading '/' anchors a pattern to the root without adding a
+    directory to it.
+    >>> match_path('a/b/c.pas', '*.pas')
+    True
+    >>> match_path('a/b/c.pas', '/*.pas')
+    False
+    >>> match_path('c.pas', '/*.pas')
+    True
+    >>> match_path('a/b/c.pas', '*/*.pas')
+    False
+    >>> match_path('a/b/c.pas', '**/*.pas')
+    True
+    >>> match_path('c.pas', '**/*.pas')
+    True
+    >>> match_path('a/b/c.pas', 'a/**/c.*')
+    True
+    """
+    if '/' not in pattern:
+        return fnmatch(rel_path.rsplit('/', 1)[-1], pattern)
+    return _match_parts(rel_path.split('/'), pattern.lstrip('/').split('/'))
+
+
+def may_match_under(rel_dir: str, pattern: str):
+    """
+    check whether a pattern (see match_path) might match any file under a directory
+    >>> may_match_under('a', '*.pas')
+    True
+    >>> may_match_under('a', '/*.pas')
+    False
+    >>> may_match_under('a/b', '*/*.pas')
+    False
+    >>> may_match_under('a/b', 'a/**/c.pas')
+    True
+    """
+    if '/' not in pattern:
+        return True
+    return _match_prefix(rel_dir.split('/'), pattern.lstrip('/').split('/'))
+
+
+def _match_parts(parts: List[str], pattern_parts: List[str]):
+    if not pattern_parts:
+        return not parts
+    head, *rest = pattern_parts
+    if head == '**':
+        return any(_match_parts(parts[i:], rest) for i in range(len(parts) + 1))
+    return bool(parts) and fnmatch(parts[0], head) and _match_parts(parts[1:], rest)
+
+
+def _match_prefix(parts: List[str], pattern_parts: List[str]):
+    if not parts:
+        # the directory itself matched, there has to be something left for the files in it
+        return bool(pattern_parts)
+    if not pattern_parts:
+        return False
+    head, *rest = pattern_parts
+    if head == '**':
+        return True
+    return fnmatch(parts[0], head) and _match_prefix(parts[1:], rest)
+
+
+def split_glob(glob_path: str) -> Tuple[str, str]:
+    """
+    split a glob into the directory its matches are under, and a pattern anchored to that directory (see match_path)
+    >>> split_glob('scripts/*/*.pas')
+    ('scripts', '/*/*.pas')
+    >>> split_glob(r'd:\\scripts\\**\\*.pas')
+    ('d:\\\\scripts', '/**/*.pas')
+    >>> split_glob('*.pas')
+    ('.', '/*.pas')
+    >>> split_glob('scripts/a.pas')
+    ('scripts', '/a.pas')
+    """
+    wildcard = re.search(r'[*?\[]', glob_path)
+    if not wildcard:
+        head, tail = os.path.split(glob_path)
+        return head or '.', '/' + tail
+    sep = max(glob_path.rfind('/', 0, wildcard.start()), glob_path.rfind('\\', 0, wildcard.start()))
+    root = glob_path[:sep] if sep > 0 else glob_path[:sep + 1] or '.'
+    return root, '/' + glob_path[sep + 1:].replace('\\', '/')
+
+
+def _scan_dir(root, rel_dir, include, exclude):
+    """
+    scan a single directory
+    :return: the (relative path, entry) pairs of the included files, and the relative paths of the subdirectories
+    """
+    files = []
+    dirs = []
+    try:
+        entries = os.scandir(os.path.join(root, rel_dir) if rel_dir else root)
+    except OSError:
+        # the directory was removed or is unreadable, there is nothing to find in it
+        return files, dirs
+    with entries:
+        for entry in entries:
+            rel_path = rel_dir + '/' + entry.name if rel_dir else entry.name
+            if any(match_path(rel_path, p) for p in exclude):
+                continue
+            try:
+                # we don't follow symlinks to directories, so that links can't make us walk in circles
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir:
+                if any(may_match_under(rel_path, p) for p in include):
+                    dirs.append(rel_path)
+            elif any(match_path(rel_path, p) for p in include):
+                files.append((rel_path, entry))
+    return files, dirs
+
+
+def _walk(root, rel_dir, include, exclude, stop: Optional[threading.Event] = None):
+    dirs = [rel_dir]
+    while dirs and not (stop and stop.is_set()):
+        files, sub_dirs = _scan_dir(root, dirs.pop(), include, exclude)
+        yield from files
+        dirs.extend(reversed(sub_dirs))
+
+
+def iter_sources(root, include: Iterable[str] = ('*.pas',), exclude: Iterable[str] = (), workers: int = None) \
+        -> Iterator[Tuple[str, os.DirEntry]]:
+    """
+    walk a directory recursively, yielding the files in it as they are found
+    :param root: the directory to walk
+    :param include: patterns of files to include (see match_path)
+    :param exclude: patterns of files and directories to leave out, excluded directories are not walked at all, and
+        neither are directories no include pattern can match anything under
+    :param workers: if set, the subdirectories of root are walked in parallel by this many threads, in which case
+        the files are yielded in no particular order
+    :return: an iterator of (path relative to root with '/' separators, os.DirEntry) pairs
+    """
+    include = tuple(p.replace('\\', '/') for p in include)
+    exclude = tuple(p.replace('\\', '/') for p in exclude)
+    if not workers:
+        yield from _walk(root, '', include, exclude)
+        return
+
+    files, dirs = _scan_dir(root, '', include, exclude)
+    found = queue.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def walk_into_queue(rel_dir):
+        try:
+            for file in _walk(root, rel_dir, include, exclude, stop):
+                found.put(file)
+        finally:
+            found.put(done)
+
+    with ThreadPoolExecutor(workers) as executor:
+        try:
+            futures = [executor.submit(walk_into_queue, d) for d in dirs]
+            yield from files
+            remaining = len(futures)
+            while remaining:
+                file = found.get()
+                if file is done:
+                    remaining -= 1
+                else:
+                    yield file
+            for future in futures:
+                future.result()
+        finally:
+            # if we stopped early, let the walkers know so the executor can shut down
+            stop.set()
@@ -1,6 +1,8 @@
-from typing import Union, Callable, Optional, List
+from typing import Union, Callable, Optional, List, Sequence, Iterable
 
 from abc import ABC, abstractmethod
+from bisect import bisect_right
+from itertools import accumulate
 
 import re
 
@@ -60,6 +62,12 @@ class Rule(ABC):
         """
         return None
 
+    def candidates(self, lines: Sequence[str]) -> Iterable[int]:
+        """
+        get the indices of the lines this rule might act on, the rule is guaranteed to return None for all other lines
+        """
+        return range(len(lines))
+
     @classmethod
     def maybe(cls, cond):
         if cond:
@@ -78,10 +86,43 @@ class _NilRule(Rule):
     def __call__(self, line, env):
         return None
 
+    def candidates(self, lines):
+        return ()
+
 
 class PatternRule(Rule, ABC):
     def __init__(self, pattern: str):
         self.pattern = re.compile(pattern, re.IGNORECASE)
+        self._multiline_pattern = None
+
+    def candidates(self, lines):
+        """
+        search all the lines at once, as a single newline-separated buffer. Matches that cross a line boundary might
+        hide matches in the lines they cross, so all these lines are returned as candidates as well.
+        note: this relies on the pattern's lookarounds treating a newline the same as the start/end of the string,
+            which is true for all the character classes used in the standard rules.
+        """
+        buffer = '\n'.join(lines)
+        if buffer.count('\n') != len(lines) - 1:
+            # some lines have newlines of their own, so we can't tell where the lines start
+            return super().candidates(lines)
+        if not self._multiline_pattern:
+            self._multiline_pattern = re.compile(self.pattern.pattern, self.pattern.flags | re.MULTILINE)
+        matches = list(self._multiline_pattern.finditer(buffer))
+        if not matches:
+            return ()
+
+        starts = [0]
+        starts.extend(accumulate(map((1).__add__, map(len, lines))))
+        ret = set()
+        for match in matches:
+            start, end = match.span()
+            first = bisect_right(starts, start) - 1
+            if end < starts[first + 1]:
+                ret.add(first)
+            else:
+                ret.update(range(first, bisect_right(starts, end)))
+        return sorted(ret)
 
 
 class EarlyReturnRule(PatternRule):
@@ -112,7 +153,11 @@ class ReReplaceRule(PatternRule):
         if self.add_prev_indent:
             ret = env['prev_indent'] + ret
         if self.hook:
-            self.hook()
+            deferred_hooks = env.get('deferred_hooks')
+            if deferred_hooks is None:
+                self.hook()
+            else:
+                deferred_hooks.append(self.hook)
         return ret
 
 
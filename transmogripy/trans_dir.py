@@ -1,75 +1,518 @@
 import warnings
 from pathlib import Path
-from glob import iglob
+from time import perf_counter
 import os.path
+import json
+import time
+import zlib
+import hashlib
+import shutil
+import tempfile
 
-from . import convert, TransmogripyWarning, FatalTransmogripyWarning
+from . import TransmogripyWarning, FatalTransmogripyWarning
+from .discover import iter_sources, split_glob, match_path
+from .worker import convert_source, ConversionWorker, ConversionTimeout
 
+PHASES = ('read', 'filter', 'rules', 'syntax', 'write')
+CONVERSION_PHASES = ('filter', 'rules', 'syntax')
 
-def trans_dir(glob_path, dst_root):
-    root_path = glob_path[:glob_path.find('*')]
-    if os.path.isdir(glob_path):
-        glob_path = os.path.join(glob_path, r'**\*.pas')
-    display = not glob_path.endswith('*.pas')
 
-    blacklist = []
-    files = iglob(glob_path)
+def print_timings(records, slowest=10):
+    """
+    print the total time spent in each phase, and a table of the slowest files
+    :param records: per-file timing records, as created by trans_dir
+    :param slowest: the number of slowest files to list
+    """
+    totals = {phase: sum(r.get(phase, 0) for r in records) for phase in PHASES}
+    total = sum(totals.values())
+    print(f'\ntotal time: {total:.3f}s')
+    for phase in PHASES:
+        share = totals[phase] / total if total else 0
+        print(f'\t{phase}: {totals[phase]:.3f}s ({share:.0%})')
 
-    count = {'ok': 0, 'skipped': 0, 'fatal': 0, 'warnings': 0}
+    if not slowest or not records:
+        return
+    print(f'\nslowest {min(slowest, len(records))} files:')
+    print('\t' + ''.join(f'{h:>9}' for h in ('total',) + PHASES) + '  file')
+    for r in sorted(records, key=lambda x: x['total'], reverse=True)[:slowest]:
+        print('\t' + ''.join(f'{r.get(h, 0):>9.3f}' for h in ('total',) + PHASES) + '  ' + r['file'])
 
-    for f in files:
-        if f in blacklist:
-            print(f'file {f} skipped')
-            count['skipped'] += 1
-            continue
+
+def print_count(count):
+    """
+    print the number of files processed, by status
+    """
+    print(f'\ntotal: {sum(count.values())} files processed')
+    for k, v in sorted(count.items(), key=lambda x: x[1], reverse=True):
+        if v == 0:
+            break  # since the values are sorted, a zero means all the rest are zero too
+        print(f'\t{k}: {v} files')
+
+
+def print_timeouts(statuses):
+    """
+    print the files whose conversion timed out
+    :param statuses: the status of every file processed, by relative path
+    """
+    timeouts = [rel_path for rel_path, status in statuses.items() if status == 'timeout']
+    if timeouts:
+        print('\ntimed out files:')
+        for rel_path in timeouts:
+            print(f'\t{rel_path}')
+
+
+def _umask():
+    # the umask can only be read by setting it
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def _replace_output(dst, fill, chmod=True):
+    """
+    create a new file next to dst, fill it, and move it over dst. Outputs of duplicates might be hardlinks to each
+    other, so an existing output must never be written to in place.
+    :param fill: a callable that creates the file at the path it is given
+    :param chmod: whether to give the new file the mode a newly created file would have, rather than the private mode
+        of a temporary file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        fill(tmp)
+        if chmod:
+            os.chmod(tmp, 0o666 & ~_umask())
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_output(dst, text):
+    """
+    write an output file, replacing (rather than overwriting) any existing file
+    """
+    _replace_output(dst, lambda tmp: Path(tmp).write_text(text))
+
+
+def copy_output(src, dst, link=False):
+    """
+    copy an output file, or hardlink it if link is set and the file system allows it. Any existing file is replaced
+    rather than overwritten.
+    """
+    if link:
+        def fill(tmp):
+            os.remove(tmp)
+            os.link(src, tmp)
 
         try:
-            source = Path(f).read_text()
-        except Exception:
+            # the link shares the mode of the original
+            _replace_output(dst, fill, chmod=False)
+            return
+        except OSError:
+            pass
+    _replace_output(dst, lambda tmp: shutil.copyfile(src, tmp))
+
+
+def _trans_duplicate(f, dst_name, count, original, original_dst, link):
+    """
+    handle a file with the same source as one that was already converted, reusing the original's result
+    """
+    status = original['status']
+    timings = {'file': f, 'status': status, 'duplicate_of': original['file'],
+               'saved': sum(original.get(phase, 0) for phase in CONVERSION_PHASES)}
+    if 'warnings' in original:
+        timings['warnings'] = original['warnings']
+    count[status] += 1
+
+    if status == 'fatal':
+        print(f'file {f} is a duplicate of {original["file"]}, which failed ({original["warnings"][0]})')
+    elif status == 'timeout':
+        print(f'file {f} timed out ({original["warnings"][0]})')
+    else:
+        if status == 'warnings':
             print(f)
-            raise
+            for w in original['warnings']:
+                print(f'\t{w}')
+        start = perf_counter()
+        os.makedirs(os.path.dirname(dst_name), exist_ok=True)
+        copy_output(original_dst, dst_name, link)
+        timings['write'] = perf_counter() - start
+    timings['total'] = sum(timings.get(phase, 0) for phase in PHASES)
+    return timings
+
+
+def trans_file(f, dst_name, count, display=False, worker: ConversionWorker = None, cache: dict = None,
+               link=False):
+    """
+    convert a single pascal file and write the result to dst_name
+    :param f: the path of the pascal file
+    :param dst_name: the path to write the python file to
+    :param count: the status counts to update
+    :param display: whether to print the source and the result instead of writing it. Files that fail syntax checking
+        are always displayed.
+    :param worker: if set, the conversion runs in this worker, and is abandoned if it runs over the worker's budget
+    :param cache: if set, the results of previous conversions by the hash of their source. Files with a source that is
+        already in the cache are not converted again, their result is copied from the previous file instead.
+    :param link: whether to hardlink the outputs of such duplicate files instead of copying them
+    :return: the timing record of the file, its status is 'displayed' if the file was displayed and not written
+    """
+    timings = {'file': f}
+    start = perf_counter()
+    try:
+        source = Path(f).read_text()
+    except Exception:
+        print(f)
+        raise
+    timings['read'] = perf_counter() - start
+
+    digest = None
+    if cache is not None:
+        # the conversion options are the same for the whole run, so the source alone decides the result
+        digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        if digest in cache:
+            ret = _trans_duplicate(f, dst_name, count, *cache[digest], link)
+            ret['read'] = timings['read']
+            ret['total'] += ret['read']
+            return ret
 
+    if worker is None:
+        dest, error, messages = convert_source(source, timings)
+    else:
         try:
-            with warnings.catch_warnings(record=True) as log:
-                dest = convert(source)
-        except NotImplementedError as e:
-            print(f'file {f} not supported ({e})')
+            dest, error, messages, worker_timings = worker.convert(source)
+        except ConversionTimeout as e:
+            print(f'file {f} timed out ({e})')
+            count['timeout'] += 1
+            timings['status'] = 'timeout'
+            timings['warnings'] = [str(e)]
+            timings['total'] = sum(timings.get(phase, 0) for phase in PHASES)
+            if digest:
+                cache[digest] = timings, dst_name
+            return timings
+        except ChildProcessError as e:
+            print(f'file {f} crashed the worker ({e})')
             count['fatal'] += 1
+            timings['status'] = 'fatal'
+            timings['warnings'] = [str(e)]
+            timings['total'] = sum(timings.get(phase, 0) for phase in PHASES)
+            if digest:
+                cache[digest] = timings, dst_name
+            return timings
+        timings.update(worker_timings)
+
+    if error:
+        if isinstance(error, NotImplementedError):
+            print(f'file {f} not supported ({error})')
         else:
-            transmogripy_warnings = []
-            for w in map(lambda x: x.message, log):
-                if isinstance(w, FatalTransmogripyWarning):
-                    display = True
-                    transmogripy_warnings.append(w)
-                elif isinstance(w, TransmogripyWarning):
-                    transmogripy_warnings.append(w)
-                else:
-                    warnings.warn(w)
-
-            if display:
-                print(f)
-                print(source)
-                print('\n ||\n\\||/\n \\/\n')
-                print(dest + '\n\n----------\n')
-                for w in transmogripy_warnings:
-                    print(w)
-                break
-            elif transmogripy_warnings:
+            print(f'file {f} could not be converted ({type(error).__name__}: {error})')
+        count['fatal'] += 1
+        timings['status'] = 'fatal'
+        timings['warnings'] = [str(error)]
+    else:
+        transmogripy_warnings = []
+        for w in messages:
+            if isinstance(w, FatalTransmogripyWarning):
+                display = True
+                transmogripy_warnings.append(w)
+            elif isinstance(w, TransmogripyWarning):
+                transmogripy_warnings.append(w)
+            else:
+                warnings.warn(w)
+
+        if display:
+            print(f)
+            print(source)
+            print('\n ||\n\\||/\n \\/\n')
+            print(dest + '\n\n----------\n')
+            for w in transmogripy_warnings:
+                print(w)
+            timings['status'] = 'displayed'
+        else:
+            if transmogripy_warnings:
                 count['warnings'] += 1
+                timings['status'] = 'warnings'
+                timings['warnings'] = [str(w) for w in transmogripy_warnings]
                 print(f)
                 for w in transmogripy_warnings:
                     print(f'\t{w}')
             else:
                 count['ok'] += 1
+                timings['status'] = 'ok'
 
-            base_name = f[len(root_path):-len('.pas')] + '.py'
-            dst_name = os.path.join(dst_root, base_name)
+            start = perf_counter()
             dst_dir = os.path.dirname(dst_name)
             os.makedirs(dst_dir, exist_ok=True)
-            Path(dst_name).write_text(dest)
+            write_output(dst_name, dest)
+            timings['write'] = perf_counter() - start
 
-    print(f'\ntotal: {sum(count.values())} files processed')
-    for k, v in sorted(count.items(), key=lambda x: x[1], reverse=True):
-        if v == 0:
-            break  # since the values are sorted, a zero means all the rest are zero too
-        print(f'\t{k}: {v} files')
+    timings['total'] = sum(timings.get(phase, 0) for phase in PHASES)
+    if digest:
+        cache[digest] = timings, dst_name
+    return timings
+
+
+def shard_of(rel_path, shard_count):
+    """
+    get the shard a file belongs to, by a stable hash of its path relative to the converted root. The result is the
+    same on every machine and platform.
+    >>> shard_of('a/b.pas', 4) == shard_of('a\\\\b.pas', 4)
+    True
+    >>> shard_of('a/b.pas', 1)
+    0
+    """
+    rel_path = rel_path.replace('\\', '/')
+    return zlib.crc32(rel_path.encode('utf-8')) % shard_count
+
+
+def merge_reports(reports, display=True):
+    """
+    merge the reports written by several shards of trans_dir into a single report
+    :param reports: the reports to merge, either as dicts or as paths to the JSON files trans_dir wrote
+    :param display: whether to print the merged totals, in the same format as a single trans_dir run
+    :return: the merged report
+    """
+    ret = {'count': {}, 'files': {}, 'warnings': {}, 'duplicates': 0, 'saved': 0}
+    shard_count = None
+    shards = set()
+    for report in reports:
+        if not isinstance(report, dict):
+            with open(report) as report_file:
+                report = json.load(report_file)
+        if shard_count is None:
+            shard_count = report['shard_count']
+        elif shard_count != report['shard_count']:
+            raise ValueError(f'cannot merge reports of {shard_count} and {report["shard_count"]} shards')
+        if report['shard_index'] in shards:
+            raise ValueError(f'shard {report["shard_index"]} was reported more than once')
+        shards.add(report['shard_index'])
+
+        for k, v in report['count'].items():
+            ret['count'][k] = ret['count'].get(k, 0) + v
+        ret['files'].update(report['files'])
+        ret['warnings'].update(report['warnings'])
+        ret['duplicates'] += report.get('duplicates', 0)
+        ret['saved'] += report.get('saved', 0)
+
+    missing = set(range(shard_count or 0)) - shards
+    if missing:
+        warnings.warn(f'reports of shards {sorted(missing)} are missing, the totals are partial')
+    if display:
+        print_count(ret['count'])
+        print_timeouts(ret['files'])
+        if ret['duplicates']:
+            print(f'\n{ret["duplicates"]} duplicate files were not converted again, saving {ret["saved"]:.3f}s')
+    return ret
+
+
+def dst_path(dst_root, rel_path):
+    """
+    get the path of the python file a source file is converted to
+    """
+    return os.path.join(dst_root, os.path.splitext(rel_path)[0] + '.py')
+
+
+def trans_dir(glob_path, dst_root, slowest=10, timing_log=None, shard_index=None, shard_count=None, report=None,
+              include=None, exclude=(), blacklist=(), workers=None, time_budget=None, cpu_budget=None,
+              dedupe=False, link_duplicates=False):
+    """
+    convert all the pascal files in a directory (or matching a glob) and write them under dst_root. Files are converted
+    as they are found, the directory is not listed in advance.
+    :param glob_path: a directory, a single pascal file, or a glob pattern of pascal files to convert (where '**'
+        matches any number of directories)
+    :param dst_root: the root directory to write the python files to
+    :param include: patterns of the files to convert (see discover.match_path). When glob_path is a directory, this
+        defaults to all the pascal files in it. When glob_path is a glob, files have to match both the glob and (if
+        set) one of these patterns.
+    :param exclude: patterns of files and directories to leave out
+    :param blacklist: paths of files to skip, either absolute or relative to the converted directory. Unlike excluded
+        files, these are counted as skipped.
+    :param workers: if set, the number of threads to walk the subdirectories with
+    :param time_budget: if set, the maximum number of seconds to spend converting a single file. Files that run over
+        their budget are abandoned and counted as timed out, and the run carries on with the rest.
+    :param cpu_budget: if set, the maximum number of CPU seconds to spend converting a single file, as time_budget
+    :param dedupe: whether to convert files with identical sources only once, the outputs of the other copies are
+        copied from the first
+    :param link_duplicates: whether to hardlink the outputs of duplicate files instead of copying them, where the file
+        system allows it
+    :param slowest: the number of slowest files to list at the end of the run (0 to list none)
+    :param timing_log: if set, the path of a JSON-lines file to write the per-file timing records to
+    :param shard_index: if set, only convert the files of this shard (see shard_of), so that several machines can each
+        convert a part of the same directory
+    :param shard_count: the total number of shards, must be set along with shard_index
+    :param report: if set, the path of a JSON file to write the run's counts, per-file statuses and warnings to. The
+        reports of all the shards can be combined with merge_reports.
+    :return: the run's report, as a dict
+    """
+    if (shard_index is None) != (shard_count is None):
+        raise ValueError('shard_index and shard_count must be set together')
+    if shard_count is not None and not 0 <= shard_index < shard_count:
+        raise ValueError(f'shard_index must be between 0 and {shard_count - 1}, got {shard_index}')
+
+    # a single file is displayed rather than written
+    display = os.path.isfile(glob_path)
+    if display:
+        root_path, name = os.path.split(glob_path)
+        files = [name]
+    else:
+        if os.path.isdir(glob_path):
+            root_path = glob_path
+            files = (rel_path for (rel_path, _) in iter_sources(root_path, include or ('*.pas',), exclude, workers))
+        else:
+            # the glob's pattern decides which directories are walked, include only filters the files found
+            root_path, pattern = split_glob(glob_path)
+            files = (rel_path for (rel_path, _) in iter_sources(root_path, (pattern,), exclude, workers)
+                     if include is None or any(match_path(rel_path, p.replace('\\', '/')) for p in include))
+
+    blacklist = {
+        (os.path.relpath(b, root_path) if os.path.isabs(b) else b).replace(os.sep, '/')
+        for b in blacklist
+    }
+
+    count = {'ok': 0, 'skipped': 0, 'fatal': 0, 'warnings': 0, 'timeout': 0}
+    records = []
+    statuses = {}
+    file_warnings = {}
+    worker = ConversionWorker(time_budget, cpu_budget) if (time_budget or cpu_budget) else None
+    cache = {} if dedupe else None
+
+    try:
+        for rel_path in files:
+            f = os.path.join(root_path, rel_path)
+            if shard_count is not None and shard_of(rel_path, shard_count) != shard_index:
+                continue
+
+            if rel_path in blacklist:
+                print(f'file {f} skipped')
+                count['skipped'] += 1
+                statuses[rel_path] = 'skipped'
+                continue
+
+            record = trans_file(f, dst_path(dst_root, rel_path), count, display, worker, cache, link_duplicates)
+            if record['status'] == 'displayed':
+                break
+            records.append(record)
+            statuses[rel_path] = record['status']
+            if 'warnings' in record:
+                file_warnings[rel_path] = record['warnings']
+    finally:
+        if worker:
+            worker.close()
+
+    print_count(count)
+    print_timeouts(statuses)
+    duplicates = [r for r in records if 'duplicate_of' in r]
+    saved = sum(r['saved'] for r in duplicates)
+    if duplicates:
+        print(f'\n{len(duplicates)} duplicate files were not converted again, saving {saved:.3f}s')
+    print_timings(records, slowest)
+    if timing_log:
+        with open(timing_log, 'w') as log_file:
+            for r in records:
+                log_file.write(json.dumps(r) + '\n')
+
+    ret = {'shard_index': shard_index or 0, 'shard_count': shard_count or 1,
+           'count': count, 'files': statuses, 'warnings': file_warnings,
+           'duplicates': len(duplicates), 'saved': saved}
+    if report:
+        with open(report, 'w') as report_file:
+            json.dump(ret, report_file, indent=1)
+    return ret
+
+
+def scan_sources(root, include=('*.pas',), exclude=()):
+    """
+    get the modification time and size of all the source files under root, keyed by their path relative to root
+    """
+    ret = {}
+    for rel_path, entry in iter_sources(root, include, exclude):
+        try:
+            stat = entry.stat()
+        except OSError:
+            # the file was removed while we were scanning, we'll pick up the change on the next poll
+            continue
+        ret[rel_path] = stat.st_mtime_ns, stat.st_size
+    return ret
+
+
+def watch_dir(src_root, dst_root, interval=1.0, debounce=2.0, max_polls=None, include=('*.pas',), exclude=()):
+    """
+    keep dst_root in sync with the pascal files in src_root, converting files as they are added or modified and
+    removing the outputs of deleted files. Since the process stays alive between conversions, the rules' compiled
+    patterns stay cached throughout.
+    :param src_root: the directory to watch
+    :param dst_root: the root directory to write the python files to
+    :param interval: the number of seconds between polls of src_root
+    :param debounce: the number of seconds a file has to stay unchanged before it is converted, so that files that are
+        still being written are only converted once they are done
+    :param max_polls: if set, stop after this many polls (by default, run until interrupted)
+    :param include: patterns of the files to convert (see discover.match_path)
+    :param exclude: patterns of files and directories to leave out
+    :return: the running status counts
+    """
+    count = {'ok': 0, 'fatal': 0, 'warnings': 0, 'deleted': 0}
+    converted = {}  # the stat of each source at the time it was last converted
+    pending = {}  # the stat of each changed source, and the time it was first seen with that stat
+
+    def remove_dst(rel):
+        try:
+            os.remove(dst_path(dst_root, rel))
+        except FileNotFoundError:
+            pass
+
+    def trans(rel, stat):
+        try:
+            record = trans_file(os.path.join(src_root, rel), dst_path(dst_root, rel), count)
+        except Exception as e:
+            # files are edited while we watch, so a half-saved or vanished file must not stop the watcher
+            print(f'file {rel} could not be converted ({type(e).__name__}: {e})')
+            record = {'status': 'fatal'}
+            count['fatal'] += 1
+        if record['status'] in ('fatal', 'displayed'):
+            # the source is no longer convertible, so any previous output is stale
+            if record['status'] == 'displayed':
+                count['fatal'] += 1
+            remove_dst(rel)
+        converted[rel] = stat
+
+    # on startup, everything is already stable, so just convert the whole tree
+    for rel, stat in sorted(scan_sources(src_root, include, exclude).items()):
+        trans(rel, stat)
+    print_count(count)
+
+    polls = 0
+    try:
+        while max_polls is None or polls < max_polls:
+            time.sleep(interval)
+            polls += 1
+            now = time.monotonic()
+            sources = scan_sources(src_root, include, exclude)
+            changed = False
+
+            for rel in pending.keys() - sources.keys():
+                del pending[rel]
+            for rel in converted.keys() - sources.keys():
+                del converted[rel]
+                remove_dst(rel)
+                print(f'file {rel} deleted')
+                count['deleted'] += 1
+                changed = True
+
+            for rel, stat in sorted(sources.items()):
+                if converted.get(rel) == stat:
+                    pending.pop(rel, None)
+                    continue
+                pending_stat, seen = pending.get(rel, (None, None))
+                if pending_stat != stat:
+                    pending[rel] = stat, now
+                elif now - seen >= debounce:
+                    del pending[rel]
+                    trans(rel, stat)
+                    changed = True
+
+            if changed:
+                print_count(count)
+    except KeyboardInterrupt:
+        pass
+    return count
@@ -0,0 +1,129 @@
+import warnings
+import multiprocessing
+import signal
+import math
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+from . import convert
+
+
+def convert_source(source, timings=None):
+    """
+    convert a pascal script, capturing the warnings and unsupported-feature errors it raises
+    :return: the python script (or None if the script is not supported), the NotImplementedError raised (or None),
+        and the messages of the warnings issued during the conversion
+    """
+    try:
+        with warnings.catch_warnings(record=True) as log:
+            dest = convert(source, timings=timings)
+    except NotImplementedError as e:
+        return None, e, []
+    return dest, None, [w.message for w in log]
+
+
+def _serve(conn, cpu_budget):
+    while True:
+        try:
+            source = conn.recv()
+        except EOFError:
+            return
+        if cpu_budget and resource:
+            # the CPU limit is on the total CPU time of the process, so it has to be moved forward for every file.
+            # when it is exceeded, the OS kills us with SIGXCPU.
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            soft = math.ceil(usage.ru_utime + usage.ru_stime + cpu_budget)
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+        timings = {}
+        try:
+            ret = convert_source(source, timings)
+        except Exception as e:
+            # send the error back rather than dying, so that it isn't mistaken for a crash of the worker
+            ret = None, e, []
+        conn.send((*ret, timings))
+
+
+class ConversionTimeout(Exception):
+    """
+    An exception indicating a conversion ran over its time budget
+    """
+    pass
+
+
+class ConversionWorker:
+    """
+    A child process that converts scripts, so that a conversion that runs over its budget can be killed without
+    stopping the whole run. After a conversion is killed, a fresh process takes its place.
+    """
+
+    def __init__(self, time_budget=None, cpu_budget=None):
+        """
+        :param time_budget: the maximum number of (wall) seconds to wait for each conversion
+        :param cpu_budget: the maximum number of CPU seconds each conversion can use (rounded up to whole seconds). On
+            systems without the resource module, this is used as the wall time budget if time_budget isn't set.
+        """
+        if cpu_budget and not resource and not time_budget:
+            time_budget = cpu_budget
+        self.time_budget = time_budget
+        self.cpu_budget = cpu_budget
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+
+    def start(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child_conn, self.cpu_budget), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def close(self):
+        if self.process is None:
+            return
+        self.conn.close()
+        self.process.terminate()
+        self.process.join()
+        self.process = self.conn = None
+
+    def restart(self):
+        self.close()
+        self.restarts += 1
+        self.start()
+
+    def convert(self, source):
+        """
+        convert a script in the worker process
+        :return: as convert_source, with the conversion's timings dict added at the end. Any error the conversion raises
+            is returned in place of the NotImplementedError.
+        :raises ConversionTimeout: if the conversion ran over its budget, the worker is restarted in this case
+        :raises ChildProcessError: if the worker process died for any other reason, it is restarted in this case too
+        """
+        if self.process is None:
+            self.start()
+        self.conn.send(source)
+        if not self.conn.poll(self.time_budget):
+            self.restart()
+            raise ConversionTimeout(f'took more than {self.time_budget} seconds')
+        try:
+            return self.conn.recv()
+        except EOFError:
+            exitcode = self.process.exitcode
+            if exitcode is None:
+                self.process.join()
+                exitcode = self.process.exitcode
+            self.restart()
+            sigxcpu = getattr(signal, 'SIGXCPU', None)
+            if sigxcpu and exitcode == -sigxcpu:
+                raise ConversionTimeout(f'took more than {self.cpu_budget} CPU seconds')
+            raise ChildProcessError(f'the worker process died with exit code {exitcode}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()